@@ -1,3 +1,8 @@
+# Only record a sample of requests; recording every one adds overhead to each
+# request, including the first request served by a new instance.
+appstats_RECORD_FRACTION = 0.1
+
+
 def webapp_add_wsgi_middleware(app):
     from google.appengine.ext.appstats import recording
     app = recording.appstats_wsgi_middleware(app)
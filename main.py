@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 
 """main.py - This file contains handlers that are called by taskqueue and/or
-cronjobs."""
+cronjobs.
+
+Modules only needed by a few handlers (mail, the mapper) are imported inside
+those handlers to keep instance start up short."""
 import webapp2
 import datetime
-from utils import get_by_urlsafe, send_turn_reminder_email
+from utils import get_by_urlsafe
+
+from models import User, Game, Tournament
 
-from models import User, Game
+# Number of top rated users whose keys the warmup request caches.
+WARMUP_USERS = 100
 
 
 class SendReminderEmail(webapp2.RequestHandler):
@@ -15,6 +21,8 @@ class SendReminderEmail(webapp2.RequestHandler):
         Send a reminder email to each User who has a pending for more than 12
         hours. Called every hour using a cron job.
         """
+        from utils import send_turn_reminder_email
+
         users = User.query(User.email != None)
         date = datetime.datetime.now()
         query = Game.query(Game.last_move <= date - datetime.timedelta(minutes=12))
@@ -29,6 +37,7 @@ class SendReminderEmail(webapp2.RequestHandler):
 class SendNotificationNextPlayer(webapp2.RequestHandler):
     def post(self, urlsafe_game_key, urlsafe_user_key):
         """Send a notification to player to play next."""
+        from utils import send_turn_reminder_email
 
         user = get_by_urlsafe(urlsafe_user_key, User)
 
@@ -36,7 +45,85 @@ class SendNotificationNextPlayer(webapp2.RequestHandler):
             send_turn_reminder_email(user, urlsafe_game_key)
 
 
+class RecordTournamentResult(webapp2.RequestHandler):
+    def post(self, urlsafe_game_key):
+        """Count the result of a finished tournament game."""
+
+        game = get_by_urlsafe(urlsafe_game_key, Game)
+
+        if game:
+            Tournament.record_result(game.key)
+
+
+class AdvanceTournament(webapp2.RequestHandler):
+    def post(self, urlsafe_tournament_key):
+        """Start the next round of an elimination tournament, or pick the
+        winner of a finished round robin."""
+
+        tournament = get_by_urlsafe(urlsafe_tournament_key, Tournament)
+
+        if tournament:
+            tournament.advance()
+
+
+class ReplayRatings(webapp2.RequestHandler):
+    def post(self):
+        """
+        Recompute every user's rating from the Score history. Runs as a
+        chain of migrations: reset_ratings, backfill_score_created and
+        replay_ratings.
+        """
+        import mapper
+
+        mapper.start_migration('reset_ratings', restart=True, internal=True)
+        self.response.write('Ratings replay started.')
+
+
+class StartMigration(webapp2.RequestHandler):
+    def post(self, name):
+        """Start or resume a migration. Pass restart=1 to start over."""
+        import mapper
+
+        try:
+            state = mapper.start_migration(
+                name, restart=self.request.get('restart') == '1')
+        except KeyError:
+            self.abort(404)
+
+        self.response.write('Migration {}: {} entities processed, {} written'
+                            '{}.'.format(name, state.processed, state.written,
+                                         ', done' if state.done else ''))
+
+
+class RunMigrationBatch(webapp2.RequestHandler):
+    def post(self, name):
+        """Migrate one batch of entities. Chained through the task queue."""
+        import mapper
+
+        mapper.run_batch(name, int(self.request.get('run')),
+                         int(self.request.get('batch')))
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """
+        Load the API modules and cache the keys of the top rated users
+        before the instance receives traffic. Called by App Engine when it
+        starts a new instance.
+        """
+        import tic_tac_toe  # noqa: loads endpoints, protorpc and models
+        from google.appengine.api import mail, taskqueue  # noqa
+
+        User.preload_keys(WARMUP_USERS)
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
     ('/tasks/notify_next_turn/(\w+)/(\w+)', SendNotificationNextPlayer),
+    ('/tasks/tournament_result/([\w-]+)', RecordTournamentResult),
+    ('/tasks/advance_tournament/([\w-]+)', AdvanceTournament),
+    ('/admin/replay_ratings', ReplayRatings),
+    ('/admin/migrate/(\w+)', StartMigration),
+    ('/tasks/migrate/(\w+)', RunMigrationBatch),
+    ('/_ah/warmup', Warmup),
 ], debug=True)
@@ -0,0 +1,234 @@
+"""mapper.py - Resumable batch processing over every entity of a kind.
+
+Used to migrate stored entities when their layout changes. A migration is a
+function registered with the migration decorator; it receives one entity at a
+time, updates it in place and returns True if it needs to be written back.
+Jobs that need a whole batch at once, or a particular order, are registered
+with batch_migration instead. A migration can name another one to start when
+it is done.
+
+Each batch runs in its own task. Progress is checkpointed in a MigrationState
+entity after every batch, in the same transaction that queues the next batch,
+so a failed task resumes from the last cursor when it is retried. A batch may
+be applied twice if its task fails after writing it, so transforms must be
+idempotent."""
+
+import time
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import INITIAL_RATING, Score, User
+
+BATCH_SIZE = 100
+# Upper bound on entity writes per second, so migrations don't starve live
+# traffic. Enforced by delaying the next batch's task.
+WRITES_PER_SECOND = 50
+
+MIGRATIONS = {}
+
+
+def migration(model, then=None, internal=False):
+    """Registers the decorated function as a migration of every entity of
+    model. The migration is named after the function; then is the name of
+    a migration to start once this one is done. Internal migrations are
+    steps of a chain and can only be started by code, not by an admin."""
+    def register(transform):
+        def process(entities, state):
+            return [entity for entity in entities if transform(entity)]
+        MIGRATIONS[transform.__name__] = (model.query(), process, then,
+                                          internal)
+        return transform
+    return register
+
+
+def batch_migration(query, then=None, internal=False):
+    """Registers the decorated function as a migration over the results of
+    query, in the query's order. The function receives each batch of
+    entities along with the MigrationState, and returns the entities, of any
+    kind, to write back."""
+    def register(process):
+        MIGRATIONS[process.__name__] = (query, process, then, internal)
+        return process
+    return register
+
+
+class MigrationState(ndb.Model):
+    """Progress of a migration, keyed by migration name.
+
+    run identifies the current chain of tasks; starting the migration again
+    gives it a new run so tasks from an older chain stop on their own.
+    """
+    run = ndb.IntegerProperty(required=True)
+    cursor = ndb.StringProperty(indexed=False)
+    batches = ndb.IntegerProperty(required=True, default=0)
+    processed = ndb.IntegerProperty(required=True, default=0)
+    written = ndb.IntegerProperty(required=True, default=0)
+    done = ndb.BooleanProperty(required=True, default=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+def _enqueue_batch(name, state, countdown=0):
+    """Queues the next batch. Must be called in the transaction that saves
+    state, so the checkpoint and the next task are committed together."""
+    taskqueue.add(url='/tasks/migrate/{}'.format(name),
+                  params={'run': state.run, 'batch': state.batches},
+                  countdown=countdown,
+                  transactional=True)
+
+
+def start_migration(name, restart=False, internal=False):
+    """
+    Starts a migration, or resumes it from its last checkpoint.
+    Args:
+        name: Name of a registered migration.
+        restart: If True, discard any previous progress and start over.
+        internal: If True, internal migrations may be started too.
+
+    Returns:
+        The MigrationState of the migration.
+    Raises:
+        KeyError: if no migration with that name is registered, or if it is
+            internal and internal is False.
+    """
+    if name not in MIGRATIONS or (MIGRATIONS[name][3] and not internal):
+        raise KeyError('Unknown migration "{}".'.format(name))
+
+    # Runs are allocated ids rather than counters, so a restart after the
+    # state was deleted can't be mistaken for an earlier chain.
+    run = MigrationState.allocate_ids(1)[0]
+    return _start_migration_txn(name, restart, run)
+
+
+@ndb.transactional
+def _start_migration_txn(name, restart, run):
+    state = MigrationState.get_by_id(name)
+    if not state or restart:
+        state = MigrationState(id=name, run=run)
+    elif state.done:
+        return state
+    else:
+        state.run = run
+
+    state.put()
+    _enqueue_batch(name, state)
+    return state
+
+
+def run_batch(name, run, batch):
+    """
+    Migrates the next batch of entities and queues the batch after it.
+    Args:
+        name: Name of a registered migration.
+        run: Chain the calling task belongs to.
+        batch: Number of batches the calling task expects to be done.
+    """
+    query, process, then, internal = MIGRATIONS[name]
+    state = MigrationState.get_by_id(name)
+    if (not state or state.done or state.run != run or
+            state.batches != batch):
+        # Superseded chain, or a duplicate of a batch already checkpointed.
+        return
+
+    batch_started = time.time()
+    cursor = Cursor(urlsafe=state.cursor) if state.cursor else None
+    entities, next_cursor, more = query.fetch_page(BATCH_SIZE,
+                                                   start_cursor=cursor)
+
+    changed = process(entities, state)
+    if changed:
+        ndb.put_multi(changed)
+
+    elapsed = time.time() - batch_started
+    _checkpoint(name, run, batch,
+                next_cursor.urlsafe() if next_cursor else None,
+                len(entities), len(changed), more,
+                max(0, len(changed) / float(WRITES_PER_SECOND) - elapsed),
+                then)
+
+
+@ndb.transactional(xg=True)
+def _checkpoint(name, run, batch, cursor, processed, written, more,
+                countdown, then):
+    """Saves the progress of a batch and queues the next one atomically. The
+    last batch starts the following migration, if any, instead."""
+    state = MigrationState.get_by_id(name)
+    if state.run != run or state.batches != batch:
+        # Restarted, or checkpointed by a concurrent copy of this task.
+        return
+
+    state.cursor = cursor
+    state.batches += 1
+    state.processed += processed
+    state.written += written
+    state.done = not more
+    state.put()
+
+    if more:
+        _enqueue_batch(name, state, countdown)
+    elif then:
+        start_migration(then, restart=True, internal=True)
+
+
+@migration(User)
+def index_user_ratings(user):
+    """Writes back users stored before ratings existed, so their default
+    rating is indexed and they show up on the leaderboard."""
+    return True
+
+
+@migration(User, then='backfill_score_created', internal=True)
+def reset_ratings(user):
+    """First step of replaying ratings: every user starts over."""
+    user.rating = INITIAL_RATING
+    user.games_rated = 0
+    user.replay_run = None
+    user.replay_batch = None
+    return True
+
+
+@migration(Score, then='replay_ratings', internal=True)
+def backfill_score_created(score):
+    """Gives Scores recorded before 'created' existed the start of their
+    day, so they are included, and sort first, when replaying ratings."""
+    if score.created:
+        return False
+    score.created = datetime.combine(score.date, datetime.min.time())
+    return True
+
+
+@batch_migration(Score.query().order(Score.date, Score.created),
+                 internal=True)
+def replay_ratings(scores, state):
+    """Last step of replaying ratings: applies every Score, oldest first.
+    Each user written is marked with the run and batch it includes, so a
+    batch retried after some of its users were saved leaves those users
+    alone instead of counting their games twice."""
+    keys = list({key for score in scores for key in (score.winner,
+                                                     score.loser)})
+    users = dict(zip(keys, ndb.get_multi(keys)))
+    applied = {key for key, user in users.iteritems()
+               if user and user.replay_run == state.run and
+               user.replay_batch == state.batches}
+
+    for score in scores:
+        winner = users[score.winner]
+        loser = users[score.loser]
+        if not winner or not loser:
+            continue
+        result = 0.5 if score.draw else 1
+        winner_rating = winner.rating
+        if winner.key not in applied:
+            winner._apply_result(loser.rating, result)
+        if loser.key not in applied:
+            loser._apply_result(winner_rating, 1 - result)
+
+    changed = [user for key, user in users.iteritems()
+               if user and key not in applied]
+    for user in changed:
+        user.replay_run = state.run
+        user.replay_batch = state.batches
+    return changed
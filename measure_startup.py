@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""measure_startup.py - Reports the cold start cost of each handler module.
+
+Every module listed in app.yaml is loaded in a fresh interpreter, the same way
+a new instance would load it. For each one this reports the import time and
+the latency of the first and second request it serves, against local API
+stubs.
+
+Usage:
+    python measure_startup.py --sdk /path/to/google_appengine
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (module, WSGI application attribute, method, path, body) for a
+# representative request to each handler module.
+HANDLER_MODULES = [
+    ('main', 'app', 'GET', '/_ah/warmup', None),
+    ('tic_tac_toe', 'api', 'POST',
+     '/_ah/spi/TicTacToeApi.get_rating_leaderboard', '{}'),
+]
+
+
+def _setup_environment(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='tic-tac-toe-startup', overwrite=True)
+    bed.init_app_identity_stub()
+    bed.init_datastore_v3_stub()
+    bed.init_mail_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    bed.init_urlfetch_stub()
+    bed.init_user_stub()
+    return bed
+
+
+def _timed_request(app, method, path, body):
+    from webob import Request
+
+    request = Request.blank(path, method=method)
+    if body is not None:
+        request.body = body
+        request.content_type = 'application/json'
+    start = time.time()
+    response = request.get_response(app)
+    return time.time() - start, response.status_int
+
+
+def measure_module(sdk, module, app_attr, method, path, body):
+    """Runs in a child process: imports module and serves two requests."""
+    _setup_environment(sdk)
+
+    start = time.time()
+    __import__(module)
+    import_time = time.time() - start
+
+    import appengine_config
+    app = appengine_config.webapp_add_wsgi_middleware(
+        getattr(sys.modules[module], app_attr))
+
+    first, status = _timed_request(app, method, path, body)
+    second, _ = _timed_request(app, method, path, body)
+
+    return {'module': module,
+            'path': path,
+            'status': status,
+            'import_ms': import_time * 1000,
+            'first_request_ms': first * 1000,
+            'second_request_ms': second * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='Path to the App Engine Python SDK.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        spec = HANDLER_MODULES[int(args.child)]
+        print(json.dumps(measure_module(args.sdk, *spec)))
+        return
+
+    print('{:<12} {:<48} {:>6} {:>10} {:>10} {:>10}'.format(
+        'module', 'path', 'status', 'import', '1st req', '2nd req'))
+    for i in range(len(HANDLER_MODULES)):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--sdk', args.sdk, '--child', str(i)])
+        result = json.loads(output.strip().splitlines()[-1])
+        print('{module:<12} {path:<48} {status:>6} {import_ms:>8.1f}ms '
+              '{first_request_ms:>8.1f}ms {second_request_ms:>8.1f}ms'
+              .format(**result))
+
+
+if __name__ == '__main__':
+    main()
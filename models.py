@@ -6,11 +6,128 @@ from datetime import date, datetime
 from protorpc import messages
 from google.appengine.ext import ndb
 
+# Datastore splits an IN filter into one sub-query per value; keep each
+# query's fan-out bounded and run the chunks concurrently instead.
+MAX_IN_FILTER_VALUES = 30
+
+# Symbols used by the compact board string, indexed by cell value.
+BOARD_SYMBOLS = {-1: '-', 0: 'O', 1: 'X'}
+
+# Fields a GameForm can be limited to. 'cells' covers cell_1..cell_9 and
+# 'board' is the compact 9 character alternative.
+GAME_FORM_FIELDS = ('game_over', 'message', 'player1_name', 'player2_name',
+                    'next_turn', 'cells', 'board')
+DEFAULT_GAME_FORM_FIELDS = ('game_over', 'message', 'player1_name',
+                            'player2_name', 'next_turn', 'cells')
+
+# Instance-wide map of user name to key, used by User.get_by_name. User names
+# are unique and never change, so entries don't go stale.
+_user_keys_by_name = {}
+
+INITIAL_RATING = 1500.0
+ELO_K_FACTOR = 32
+
+
+def _elo_rating(rating, opponent_rating, result):
+    """Returns the new Elo rating of a player. result is 1 for a win, 0.5
+    for a draw and 0 for a loss."""
+    expected = 1 / (1 + 10 ** ((opponent_rating - rating) / 400.0))
+    return rating + ELO_K_FACTOR * (result - expected)
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile
+
+    rating is an Elo skill rating updated at the end of every game. It is
+    indexed so leaderboards and a user's rank are single queries.
+    """
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
+    rating = ndb.FloatProperty(required=True, default=INITIAL_RATING)
+    games_rated = ndb.IntegerProperty(required=True, default=0)
+    # Last ratings replay run and batch applied to this user; see mapper.py.
+    replay_run = ndb.IntegerProperty(required=False, indexed=False)
+    replay_batch = ndb.IntegerProperty(required=False, indexed=False)
+
+    def _apply_result(self, opponent_rating, result):
+        self.rating = _elo_rating(self.rating, opponent_rating, result)
+        self.games_rated += 1
+
+    @staticmethod
+    def rate_game(player1, player2, winner_key):
+        """
+        Updates the ratings of both players of a finished game. The users
+        are not saved.
+        Args:
+            player1: The game's first player.
+            player2: The game's second player.
+            winner_key: Key of the winner, or None for a draw.
+        """
+        if not winner_key:
+            result = 0.5
+        else:
+            result = 1 if winner_key == player1.key else 0
+
+        rating1 = player1.rating
+        player1._apply_result(player2.rating, result)
+        player2._apply_result(rating1, 1 - result)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """
+        Returns the User with the given name, or None. Keys found are kept
+        in an instance-wide map, so looking the same user up again is a
+        get by key instead of a query.
+        """
+        if not name:
+            return None
+
+        key = _user_keys_by_name.get(name)
+        user = key.get() if key else None
+        if not user:
+            user = cls.query(cls.name == name).get()
+            if user:
+                _user_keys_by_name[name] = user.key
+        return user
+
+    @classmethod
+    def preload_keys(cls, limit):
+        """Fills this instance's name to key map with the top rated
+        users."""
+        for user in cls.query().order(-cls.rating).fetch(
+                limit, projection=[cls.name]):
+            _user_keys_by_name[user.name] = user.key
+
+    def get_rank(self):
+        """Returns the user's rank on the rating leaderboard: one more than
+        the number of users rated higher, so tied users share a rank."""
+        return User.query(User.rating > self.rating).count() + 1
+
+    def to_rating_form(self, rank):
+        return RatingForm(user_name=self.name,
+                          rank=rank,
+                          rating=self.rating,
+                          games=self.games_rated)
+
+    @classmethod
+    def get_by_names(cls, names):
+        """
+        Resolves many user names at once.
+        Args:
+            names: List of user names.
+
+        Returns:
+            Dict mapping each existing user name to its User entity. Names
+            with no matching User are left out.
+        """
+        futures = [cls.query(cls.name.IN(names[i:i + MAX_IN_FILTER_VALUES]))
+                   .fetch_async()
+                   for i in range(0, len(names), MAX_IN_FILTER_VALUES)]
+        users = {}
+        for future in futures:
+            for user in future.get_result():
+                users[user.name] = user
+        return users
 
 
 class MoveHistory(ndb.Model):
@@ -39,6 +156,10 @@ class Game(ndb.Model):
      0 (O), or 1 (X).
 
      player1 is automatically assigned 'X', player2 is 'O'.
+
+     Games played as part of a Tournament reference it through the
+     tournament property, along with the round they belong to.
+     tournament_recorded is set once the game's result has been counted.
     """
 
     game_over = ndb.BooleanProperty(required=True, default=False)
@@ -58,6 +179,9 @@ class Game(ndb.Model):
     cell_8 = ndb.IntegerProperty(required=False, default=-1)
     cell_9 = ndb.IntegerProperty(required=False, default=-1)
     history = ndb.LocalStructuredProperty(MoveHistory, repeated=True)
+    tournament = ndb.KeyProperty(required=False, kind='Tournament')
+    tournament_round = ndb.IntegerProperty(required=False)
+    tournament_recorded = ndb.BooleanProperty(required=False, default=False)
 
     @property
     def grid(self):
@@ -79,6 +203,13 @@ class Game(ndb.Model):
                 setattr(self, 'cell_{}'.format(i), grid_list[j][k])
                 i += 1
 
+    @property
+    def board(self):
+        """Returns the game grid as a 9 character string, cell_1 first,
+        using 'X', 'O' and '-' for empty cells."""
+        return ''.join(BOARD_SYMBOLS[getattr(self, attr_name)]
+                       for attr_name in self._cell_names())
+
     @staticmethod
     def _cell_names():
         for i in range(1, 10):
@@ -130,54 +261,90 @@ class Game(ndb.Model):
                 total += 1
         return total
 
-    def to_form(self, message=''):
-        """Returns a GameForm representation of the Game"""
+    def to_form(self, message='', fields=DEFAULT_GAME_FORM_FIELDS):
+        """Returns a GameForm representation of the Game, limited to the
+        given GAME_FORM_FIELDS. Player names are only looked up when one of
+        the name fields is requested."""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.player1_name = self.player1.get().name
-        form.player2_name = self.player2.get().name if self.player2 else None
-        form.game_over = self.game_over
-        form.message = message
-        form.next_turn = self.next_turn.get().name
 
-        for attr_name in self._cell_names():
-            setattr(form, attr_name, getattr(self, attr_name))
+        user_keys = []
+        if 'player1_name' in fields:
+            user_keys.append(self.player1)
+        if 'player2_name' in fields and self.player2:
+            user_keys.append(self.player2)
+        if 'next_turn' in fields:
+            user_keys.append(self.next_turn)
+        names = {user.key: user.name
+                 for user in ndb.get_multi(set(user_keys))}
+
+        if 'player1_name' in fields:
+            form.player1_name = names[self.player1]
+        if 'player2_name' in fields and self.player2:
+            form.player2_name = names[self.player2]
+        if 'next_turn' in fields:
+            form.next_turn = names[self.next_turn]
+        if 'game_over' in fields:
+            form.game_over = self.game_over
+        if 'message' in fields:
+            form.message = message
+        if 'cells' in fields:
+            for attr_name in self._cell_names():
+                setattr(form, attr_name, getattr(self, attr_name))
+        if 'board' in fields:
+            form.board = self.board
 
         return form
 
     def get_history_forms(self):
         return MoveHistoryForms(items=[event.to_form() for event in self.history])
 
+    @ndb.transactional(xg=True)
     def end_game(self, winner):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
-        futures = []
+        the player lost. The game, its Score and both players' ratings are
+        saved in a single transaction."""
         self.game_over = True
         self.winner = winner
-        futures.append(self.put_async())
 
-        if not winner:
-            loser = None
+        player1, player2 = ndb.get_multi([self.player1, self.player2])
+        User.rate_game(player1, player2, winner)
+        if winner == self.player2:
+            winner_user, loser_user = player2, player1
         else:
-            loser = self.player2 if winner == self.player1 else self.player1
+            winner_user, loser_user = player1, player2
 
         # Add the game to the 'score board'
         score = Score(parent=self.key, date=date.today(),
-                      winner=winner, winner_name=winner.get().name,
-                      loser=loser, loser_name=loser.get().name,
-                      winner_moves=self.get_number_of_moves(winner))
-        futures.append(score.put_async())
-        ndb.Future.wait_all(futures)
+                      winner=winner_user.key, winner_name=winner_user.name,
+                      loser=loser_user.key, loser_name=loser_user.name,
+                      winner_moves=self.get_number_of_moves(winner_user.key),
+                      draw=not winner)
+        ndb.put_multi([self, score, player1, player2])
+
+        if self.tournament:
+            from google.appengine.api import taskqueue
+
+            # Queued with the game's end so the result is recorded exactly
+            # when the game is over, and retried until it is.
+            taskqueue.add(url='/tasks/tournament_result/{}'
+                          .format(self.key.urlsafe()),
+                          transactional=True)
 
 
 class Score(ndb.Model):
-    """Score object"""
+    """Score object
+
+    For a draw, winner and loser hold player1 and player2 respectively.
+    """
     winner = ndb.KeyProperty(required=True, kind='User')
     winner_name = ndb.StringProperty(required=True)
     loser = ndb.KeyProperty(required=True, kind='User')
     loser_name = ndb.StringProperty(required=True)
     date = ndb.DateProperty(required=True)
     winner_moves = ndb.IntegerProperty(required=True)
+    draw = ndb.BooleanProperty(required=True, default=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
 
     @ndb.tasklet
     def get_winner_name_future(self):
@@ -197,7 +364,279 @@ class Score(ndb.Model):
     def to_form(self):
         return ScoreForm(winner=self.winner_name,
                          date=str(self.date),
-                         moves=self.winner_moves)
+                         moves=self.winner_moves,
+                         draw=self.draw)
+
+
+class Tournament(ndb.Model):
+    """Tournament object
+
+    A tournament groups Games between registered users and comes in two
+    formats:
+
+     round_robin: every player meets every other player once. All games are
+     created up front and scheduled into rounds so that each player plays
+     at most one game per round.
+
+     elimination: players are paired off one round at a time. Winners
+     advance to the next round; a draw is replayed with the symbols swapped.
+     With an odd number of players, one player who has not had a bye yet
+     sits the round out and advances.
+
+    round_games and games_remaining track the elimination round in progress,
+    so advancing the bracket never needs a query.
+    """
+    ROUND_ROBIN = 'round_robin'
+    ELIMINATION = 'elimination'
+
+    name = ndb.StringProperty(required=True)
+    format = ndb.StringProperty(required=True,
+                                choices=[ROUND_ROBIN, ELIMINATION])
+    players = ndb.KeyProperty(required=True, kind='User', repeated=True)
+    current_round = ndb.IntegerProperty(required=True, default=1)
+    round_games = ndb.KeyProperty(kind='Game', repeated=True)
+    bye = ndb.KeyProperty(required=False, kind='User')
+    had_bye = ndb.KeyProperty(kind='User', repeated=True)
+    games_remaining = ndb.IntegerProperty(required=True, default=0)
+    finished = ndb.BooleanProperty(required=True, default=False)
+    winner = ndb.KeyProperty(required=False, kind='User')
+
+    @staticmethod
+    def _round_robin_schedule(player_keys):
+        """Yields (round, player1, player2) for every pairing, using the
+        circle method to spread the games over the rounds. player1 plays X;
+        every player gets X in half their games, give or take one."""
+        players = list(player_keys)
+        if len(players) % 2:
+            # The fixed seat is the bye, so the rotating colours below stay
+            # balanced for everyone.
+            players.insert(0, None)
+        n = len(players)
+
+        for round_number in range(1, n):
+            for i in range(n // 2):
+                player1, player2 = players[i], players[n - 1 - i]
+                if player1 and player2:
+                    # The fixed seat alternates colours from round to round;
+                    # on the other boards colours follow the board number.
+                    if i == 0:
+                        swap = round_number % 2 == 0
+                    else:
+                        swap = i % 2 == 0
+                    if swap:
+                        player1, player2 = player2, player1
+                    yield round_number, player1, player2
+            players.insert(1, players.pop())
+
+    def _new_game(self, player1_key, player2_key, round_number, key=None):
+        return Game(key=key,
+                    player1=player1_key,
+                    player2=player2_key,
+                    next_turn=player1_key,
+                    game_over=False,
+                    tournament=self.key,
+                    tournament_round=round_number)
+
+    def _build_round(self, player_keys):
+        """
+        Pairs up players for the current elimination round.
+        Args:
+            player_keys: Keys of the players still in the tournament, in
+                bracket order.
+
+        Returns:
+            List of unsaved Game instances. Game keys are derived from the
+            tournament, round and slot so rebuilding a round is idempotent.
+        """
+        player_keys = list(player_keys)
+        self.bye = None
+        if len(player_keys) % 2:
+            # The last player in bracket order who has not had a bye yet sits
+            # this round out, so nobody gets more than one bye.
+            candidates = [key for key in player_keys
+                          if key not in self.had_bye] or player_keys
+            self.bye = candidates[-1]
+            player_keys.remove(self.bye)
+            self.had_bye.append(self.bye)
+
+        games = []
+        for slot in range(len(player_keys) // 2):
+            key = ndb.Key(Game, '{}-{}-{}'.format(
+                self.key.id(), self.current_round, slot))
+            games.append(self._new_game(player_keys[2 * slot],
+                                        player_keys[2 * slot + 1],
+                                        self.current_round,
+                                        key=key))
+
+        self.round_games = [game.key for game in games]
+        self.games_remaining = len(games)
+        return games
+
+    @classmethod
+    def new_tournament(cls, name, format, player_keys):
+        """Creates a tournament and all of its initial games in a single
+        batch write."""
+        tournament = cls(id=cls.allocate_ids(1)[0],
+                         name=name,
+                         format=format,
+                         players=player_keys)
+
+        if format == cls.ROUND_ROBIN:
+            games = [tournament._new_game(player1, player2, round_number)
+                     for round_number, player1, player2
+                     in cls._round_robin_schedule(player_keys)]
+            tournament.games_remaining = len(games)
+        else:
+            games = tournament._build_round(player_keys)
+
+        ndb.put_multi(games + [tournament])
+        return tournament
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def record_result(cls, game_key):
+        """
+        Records the outcome of a finished tournament game. Runs in a task
+        queued by Game.end_game; recording a game twice has no effect.
+        Args:
+            game_key: Key of the finished Game.
+        """
+        game = game_key.get()
+        if game.tournament_recorded:
+            return
+        game.tournament_recorded = True
+
+        tournament = game.tournament.get()
+        if tournament.finished:
+            game.put()
+            return
+
+        if tournament.format == cls.ELIMINATION and not game.winner:
+            rematch = tournament._new_game(game.player2, game.player1,
+                                           game.tournament_round)
+            rematch.put()
+            index = tournament.round_games.index(game.key)
+            tournament.round_games[index] = rematch.key
+            ndb.put_multi([game, tournament])
+            return
+
+        tournament.games_remaining -= 1
+        if not tournament.games_remaining:
+            from google.appengine.api import taskqueue
+
+            # Creating the next round touches one entity group per game, and
+            # a round robin winner needs a query, so both are done outside of
+            # this transaction.
+            taskqueue.add(url='/tasks/advance_tournament/{}'
+                          .format(tournament.key.urlsafe()),
+                          transactional=True)
+        ndb.put_multi([game, tournament])
+
+    def advance(self):
+        """
+        Starts the next elimination round once every game of the current
+        round is over, or picks the winner of a round robin once all of its
+        games are over. Does nothing if games are still in progress, so it
+        is safe to retry.
+        Raises:
+            ValueError: if the standings don't include every round robin
+                game yet; the task is retried until they do.
+        """
+        if self.finished or self.games_remaining:
+            return
+
+        if self.format == self.ROUND_ROBIN:
+            ranked, games_counted = self._rank_players()
+            games_total = len(self.players) * (len(self.players) - 1) // 2
+            # The standings query is eventually consistent, so the last
+            # games may not be visible yet.
+            if games_counted < games_total:
+                raise ValueError('Standings are missing games.')
+            self.finished = True
+            self.winner = ranked[0][0].key
+            self.put()
+            return
+
+        games = ndb.get_multi(self.round_games)
+        advancing = [game.winner for game in games]
+        if self.bye:
+            advancing.append(self.bye)
+
+        if len(advancing) == 1:
+            self.finished = True
+            self.winner = advancing[0]
+            self.round_games = []
+            self.bye = None
+            self.put()
+            return
+
+        self.current_round += 1
+        games = self._build_round(advancing)
+        # A retry may find the round already written and being played, so
+        # only games that don't exist yet are saved. Games are written before
+        # the tournament so that it never references a missing round.
+        existing = ndb.get_multi([game.key for game in games])
+        ndb.put_multi([game for game, stored in zip(games, existing)
+                       if not stored])
+        self.put()
+
+    def _rank_players(self):
+        """
+        Computes the standings from the tournament's finished games. A win
+        is worth one point and a draw half a point; ties are broken by wins,
+        then by name.
+
+        Returns:
+            A list of (User, standing) tuples, best first, and the number of
+            finished games counted.
+        """
+        games = Game.query(Game.tournament == self.key,
+                           Game.game_over == True).fetch()
+        standings = {key: {'wins': 0, 'losses': 0, 'draws': 0}
+                     for key in self.players}
+
+        for game in games:
+            if game.winner:
+                loser = (game.player2 if game.winner == game.player1
+                         else game.player1)
+                standings[game.winner]['wins'] += 1
+                standings[loser]['losses'] += 1
+            else:
+                standings[game.player1]['draws'] += 1
+                standings[game.player2]['draws'] += 1
+
+        users = ndb.get_multi(self.players)
+        ranked = sorted(
+            ((user, standings[user.key]) for user in users),
+            key=lambda x: (-(x[1]['wins'] + x[1]['draws'] / 2.0),
+                           -x[1]['wins'], x[0].name))
+        return ranked, len(games)
+
+    def get_standings(self):
+        """Returns the standings as StandingForms."""
+        ranked, _ = self._rank_players()
+        return StandingForms(
+            items=[StandingForm(user_name=user.name,
+                                rank=rank + 1,
+                                wins=standing['wins'],
+                                losses=standing['losses'],
+                                draws=standing['draws'],
+                                points=(standing['wins'] +
+                                        standing['draws'] / 2.0))
+                   for rank, (user, standing) in enumerate(ranked)])
+
+    def to_form(self):
+        """Returns a TournamentForm representation of the Tournament"""
+        form = TournamentForm()
+        form.urlsafe_key = self.key.urlsafe()
+        form.name = self.name
+        form.format = self.format
+        form.players = len(self.players)
+        form.current_round = self.current_round
+        form.finished = self.finished
+        form.winner_name = self.winner.get().name if self.winner else None
+        form.round_games = [key.urlsafe() for key in self.round_games]
+        return form
 
 
 class MoveHistoryForm(messages.Message):
@@ -212,22 +651,24 @@ class MoveHistoryForms(messages.Message):
 
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information. Only urlsafe_key is
+    always set; the other fields can be left out on request."""
     urlsafe_key = messages.StringField(1, required=True)
-    game_over = messages.BooleanField(2, required=True)
-    message = messages.StringField(3, required=True)
-    player1_name = messages.StringField(4, required=True)
+    game_over = messages.BooleanField(2, required=False)
+    message = messages.StringField(3, required=False)
+    player1_name = messages.StringField(4, required=False)
     player2_name = messages.StringField(5, required=False)
-    next_turn = messages.StringField(6, required=True)
-    cell_1 = messages.IntegerField(7, required=True)
-    cell_2 = messages.IntegerField(8, required=True)
-    cell_3 = messages.IntegerField(9, required=True)
-    cell_4 = messages.IntegerField(10, required=True)
-    cell_5 = messages.IntegerField(11, required=True)
-    cell_6 = messages.IntegerField(12, required=True)
-    cell_7 = messages.IntegerField(13, required=True)
-    cell_8 = messages.IntegerField(14, required=True)
-    cell_9 = messages.IntegerField(15, required=True)
+    next_turn = messages.StringField(6, required=False)
+    cell_1 = messages.IntegerField(7, required=False)
+    cell_2 = messages.IntegerField(8, required=False)
+    cell_3 = messages.IntegerField(9, required=False)
+    cell_4 = messages.IntegerField(10, required=False)
+    cell_5 = messages.IntegerField(11, required=False)
+    cell_6 = messages.IntegerField(12, required=False)
+    cell_7 = messages.IntegerField(13, required=False)
+    cell_8 = messages.IntegerField(14, required=False)
+    cell_9 = messages.IntegerField(15, required=False)
+    board = messages.StringField(16, required=False)
 
 
 class GameForms(messages.Message):
@@ -252,6 +693,7 @@ class ScoreForm(messages.Message):
     winner = messages.StringField(1, required=True)
     date = messages.StringField(2, required=True)
     moves = messages.IntegerField(3, required=True)
+    draw = messages.BooleanField(4, required=False)
 
 
 class ScoreForms(messages.Message):
@@ -271,6 +713,53 @@ class RankingForms(messages.Message):
     items = messages.MessageField(RankingForm, 1, repeated=True)
 
 
+class RatingForm(messages.Message):
+    """Outbound rating information"""
+    user_name = messages.StringField(1, required=True)
+    rank = messages.IntegerField(2, required=True)
+    rating = messages.FloatField(3, required=True)
+    games = messages.IntegerField(4, required=True)
+
+
+class RatingForms(messages.Message):
+    """Return multiple RatingForm"""
+    items = messages.MessageField(RatingForm, 1, repeated=True)
+
+
+class NewTournamentForm(messages.Message):
+    """Used to create a new tournament"""
+    name = messages.StringField(1, required=True)
+    format = messages.StringField(2, required=True)
+    player_names = messages.StringField(3, repeated=True)
+
+
+class TournamentForm(messages.Message):
+    """TournamentForm for outbound tournament information"""
+    urlsafe_key = messages.StringField(1, required=True)
+    name = messages.StringField(2, required=True)
+    format = messages.StringField(3, required=True)
+    players = messages.IntegerField(4, required=True)
+    current_round = messages.IntegerField(5, required=True)
+    finished = messages.BooleanField(6, required=True)
+    winner_name = messages.StringField(7, required=False)
+    round_games = messages.StringField(8, repeated=True)
+
+
+class StandingForm(messages.Message):
+    """Outbound tournament standing information"""
+    user_name = messages.StringField(1, required=True)
+    rank = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    losses = messages.IntegerField(4, required=True)
+    draws = messages.IntegerField(5, required=True)
+    points = messages.FloatField(6, required=True)
+
+
+class StandingForms(messages.Message):
+    """Return multiple StandingForm"""
+    items = messages.MessageField(StandingForm, 1, repeated=True)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     message = messages.StringField(1, required=True)
@@ -12,16 +12,23 @@ from google.appengine.ext import ndb
 from google.appengine.ext.db import TransactionFailedError
 
 from models import (
+    DEFAULT_GAME_FORM_FIELDS,
+    GAME_FORM_FIELDS,
     Game,
     GameForm,
     GameForms,
     MakeMoveForm,
     MoveHistoryForms,
+    NewTournamentForm,
     RankingForm,
     RankingForms,
+    RatingForms,
     Score,
     ScoreForms,
+    StandingForms,
     StringMessage,
+    Tournament,
+    TournamentForm,
     User,
     PlayersForm,
 )
@@ -38,9 +45,14 @@ JOIN_GAME_REQUEST = endpoints.ResourceContainer(
 URL_SAFE_KEY_CONTAINER = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),
 )
+GET_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    include=messages.StringField(2),
+)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),
+    include=messages.StringField(2),
 )
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
@@ -49,9 +61,17 @@ USER_REQUEST = endpoints.ResourceContainer(
 GET_USER_GAMES_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1)
 )
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1, default=10)
+)
+NEW_TOURNAMENT_REQUEST = endpoints.ResourceContainer(NewTournamentForm)
+TOURNAMENT_KEY_CONTAINER = endpoints.ResourceContainer(
+    urlsafe_tournament_key=messages.StringField(1),
+)
 
 
 MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+MAX_LEADERBOARD_SIZE = 100
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 
 
@@ -77,6 +97,45 @@ class TicTacToeApi(remote.Service):
 
         return game
 
+    def _get_form_fields(self, include):
+        """
+        Parses the comma separated list of GameForm fields requested. The
+        parameter is not called 'fields', which Endpoints reserves for its
+        own partial responses.
+        Args:
+            include: Requested field names, or None for the default fields.
+
+        Returns:
+            Tuple of field names to pass to Game.to_form.
+        """
+        if not include:
+            return DEFAULT_GAME_FORM_FIELDS
+
+        fields = tuple(field.strip() for field in include.split(','))
+        unknown = [field for field in fields if field not in GAME_FORM_FIELDS]
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown field(s): {}. Valid fields are: {}.'.format(
+                    ', '.join(unknown), ', '.join(GAME_FORM_FIELDS)))
+
+        return fields
+
+    def _get_tournament(self, urlsafe_tournament_key):
+        """
+        Retrieves a tournament by its URL safe key.
+        Args:
+            urlsafe_tournament_key: URL safe key for tournament to retrieve.
+
+        Returns:
+            Tournament instance.
+        """
+        tournament = get_by_urlsafe(urlsafe_tournament_key, Tournament)
+
+        if not tournament:
+            raise endpoints.NotFoundException('Tournament not found!')
+
+        return tournament
+
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=StringMessage,
                       path='user/create',
@@ -106,13 +165,13 @@ class TicTacToeApi(remote.Service):
         Creates a new game.
         Returns a GameForm describing the game.
         """
-        player1 = User.query(User.name == request.player_1).get()
+        player1 = User.get_by_name(request.player_1)
 
         if not player1:
             raise endpoints.NotFoundException(
                     'No user named "{}" was found.'.format(request.player_1))
 
-        player2 = User.query(User.name == request.player_2).get()
+        player2 = User.get_by_name(request.player_2)
 
         if request.player_2 and not player2:
             raise endpoints.NotFoundException(
@@ -135,7 +194,7 @@ class TicTacToeApi(remote.Service):
         Joins user to game as player2.
         Returns a GameForm describing the game.
         """
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
@@ -156,18 +215,20 @@ class TicTacToeApi(remote.Service):
         return game.to_form("You've joined the game. Good luck playing "
                             "Tic Tac Toe!")
 
-    @endpoints.method(request_message=URL_SAFE_KEY_CONTAINER,
+    @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
     def get_game(self, request):
         """Return the current game state."""
+        fields = self._get_form_fields(request.include)
         game = self._get_game(request.urlsafe_game_key)
         if game.game_over:
-            return game.to_form('This game is alresdy over. Start a new game.')
+            return game.to_form('This game is alresdy over. Start a new game.',
+                                fields)
         else:
-            return game.to_form('Time to make a move!')
+            return game.to_form('Time to make a move!', fields)
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
@@ -177,15 +238,16 @@ class TicTacToeApi(remote.Service):
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
 
+        fields = self._get_form_fields(request.include)
         game = self._get_game(request.urlsafe_game_key)
 
         if game.game_over:
-            return game.to_form('Game already over.')
+            return game.to_form('Game already over.', fields)
 
         if not game.player2:
             raise endpoints.NotFoundException('Waiting for player 2 to join.')
 
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
 
         if not user:
             raise endpoints.NotFoundException('User "{}" does not exist.'
@@ -213,15 +275,15 @@ class TicTacToeApi(remote.Service):
         symbol = TicTacToeApi.check_for_win(game=game)
         if symbol > -1:
             game.end_game(winner=user.key)
-            return game.to_form('You won!')
+            return game.to_form('You won!', fields)
         elif TicTacToeApi.is_grid_full(game):
             game.end_game(winner=None)
-            return game.to_form('It is a draw!')
+            return game.to_form('It is a draw!', fields)
 
         game.put()
         taskqueue.add(url='/tasks/notify_next_turn/{}/{}'
                       .format(request.urlsafe_game_key, game.next_turn.urlsafe()))
-        return game.to_form()
+        return game.to_form(fields=fields)
 
     @staticmethod
     def check_for_win(game):
@@ -275,7 +337,7 @@ class TicTacToeApi(remote.Service):
                       http_method='GET')
     def get_user_scores(self, request):
         """Retrieves all of an individual User's scores."""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
@@ -289,7 +351,7 @@ class TicTacToeApi(remote.Service):
                       http_method='GET')
     def get_user_games(self, request):
         """Retrieves all games created by a user."""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
@@ -315,6 +377,9 @@ class TicTacToeApi(remote.Service):
         if game.game_over:
             raise endpoints.BadRequestException(
                 'Game cannot be cancelled because it is already over.')
+        elif game.tournament:
+            raise endpoints.BadRequestException(
+                'Tournament games cannot be cancelled.')
         else:
             game.cancelled = True
             game.game_over = True
@@ -332,6 +397,9 @@ class TicTacToeApi(remote.Service):
         performance = {}
 
         for score in scores:
+            if score.draw:
+                continue
+
             if score.winner in performance:
                 ranking = performance[score.winner]
                 ranking['wins'] += 1
@@ -368,6 +436,39 @@ class TicTacToeApi(remote.Service):
     def _win_loss_ratio(self, wins, losses):
         return wins / float(wins + losses)
 
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=RatingForms,
+                      path='user/ratings',
+                      name='get_rating_leaderboard',
+                      http_method='GET')
+    def get_rating_leaderboard(self, request):
+        """Returns the top rated users, highest rating first. Users with the
+        same rating share a rank, as in get_user_rating."""
+        if not 1 <= request.limit <= MAX_LEADERBOARD_SIZE:
+            raise endpoints.BadRequestException(
+                'limit must be between 1 and {}.'.format(MAX_LEADERBOARD_SIZE))
+
+        users = User.query().order(-User.rating).fetch(request.limit)
+        items = []
+        for position, user in enumerate(users):
+            if not items or user.rating != users[position - 1].rating:
+                rank = position + 1
+            items.append(user.to_rating_form(rank))
+        return RatingForms(items=items)
+
+    @endpoints.method(request_message=GET_USER_GAMES_REQUEST,
+                      response_message=RatingForms,
+                      path='user/rating/{user_name}',
+                      name='get_user_rating',
+                      http_method='GET')
+    def get_user_rating(self, request):
+        """Returns an individual User's rating and leaderboard rank."""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        return RatingForms(items=[user.to_rating_form(user.get_rank())])
+
     @endpoints.method(request_message=URL_SAFE_KEY_CONTAINER,
                       response_message=MoveHistoryForms,
                       path='game/{urlsafe_game_key}/history',
@@ -377,6 +478,65 @@ class TicTacToeApi(remote.Service):
         game = self._get_game(request.urlsafe_game_key)
         return game.get_history_forms()
 
+    @endpoints.method(request_message=NEW_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament/new',
+                      name='create_tournament',
+                      http_method='POST')
+    def create_tournament(self, request):
+        """
+        Creates a tournament and all of its initial games.
+        Returns a TournamentForm describing the tournament.
+        """
+        if request.format not in (Tournament.ROUND_ROBIN,
+                                  Tournament.ELIMINATION):
+            raise endpoints.BadRequestException(
+                'Format must be "{}" or "{}".'.format(Tournament.ROUND_ROBIN,
+                                                      Tournament.ELIMINATION))
+
+        names = request.player_names
+        if len(names) < 2:
+            raise endpoints.BadRequestException(
+                'A tournament needs at least two players.')
+        if len(set(names)) != len(names):
+            raise endpoints.BadRequestException(
+                'Each player can only be registered once.')
+
+        users = User.get_by_names(names)
+        missing = [name for name in names if name not in users]
+        if missing:
+            raise endpoints.NotFoundException(
+                'No user named {} was found.'.format(
+                    ', '.join('"{}"'.format(name) for name in missing)))
+
+        try:
+            tournament = Tournament.new_tournament(
+                request.name, request.format,
+                [users[name].key for name in names])
+        except TransactionFailedError:
+            raise endpoints.BadRequestException('Error saving Tournament.')
+
+        return tournament.to_form()
+
+    @endpoints.method(request_message=TOURNAMENT_KEY_CONTAINER,
+                      response_message=TournamentForm,
+                      path='tournament/{urlsafe_tournament_key}',
+                      name='get_tournament',
+                      http_method='GET')
+    def get_tournament(self, request):
+        """Return the current tournament state."""
+        return self._get_tournament(request.urlsafe_tournament_key).to_form()
+
+    @endpoints.method(request_message=TOURNAMENT_KEY_CONTAINER,
+                      response_message=StandingForms,
+                      path='tournament/{urlsafe_tournament_key}/standings',
+                      name='get_tournament_standings',
+                      http_method='GET')
+    def get_tournament_standings(self, request):
+        """Computes the standings of the given tournament."""
+        tournament = self._get_tournament(request.urlsafe_tournament_key)
+        return tournament.get_standings()
+
 
 # registers API
 api = endpoints.api_server([TicTacToeApi])
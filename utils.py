@@ -1,8 +1,9 @@
-"""utils.py - File for collecting general utility functions."""
+"""utils.py - File for collecting general utility functions.
+
+endpoints is only imported when a key is invalid, so the cron and task
+handlers in main.py can use this module without loading it."""
 
-import endpoints
 from google.appengine.ext import ndb
-from google.appengine.api import mail, app_identity
 
 
 def get_by_urlsafe(urlsafe, model):
@@ -21,9 +22,11 @@ def get_by_urlsafe(urlsafe, model):
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError as e:
+        import endpoints
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
         if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            import endpoints
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
@@ -37,6 +40,8 @@ def get_by_urlsafe(urlsafe, model):
 
 
 def send_turn_reminder_email(user, urlsafe_game_key):
+    from google.appengine.api import mail, app_identity
+
     app_id = app_identity.get_application_id()
     subject = "It's your turn!"
     body = ("Hello {}, \n\nIt's your turn to play! Following is your "